@@ -8,13 +8,18 @@ Features:
 - Normalization and validation using Pydantic models
 """
 
+import io
 import os
+import re
+import asyncio
+import argparse
+import math
 import json
-import fitz  # PyMuPDF
+import functools
+import orjson
 from dotenv import load_dotenv
-import google.generativeai as genai
 from typing import List, Optional
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, ValidationError, field_serializer
 
 
 # ---------------------------
@@ -42,7 +47,7 @@ class Contact(BaseModel):
 class Header(BaseModel):
     ship_to: Party
     bill_to: Party
-    vendor: Optional[Party] = "None"
+    vendor: Optional[Party] = None
     buyer_contact: Contact
     shipping_contact: Contact
     project_number: Optional[str] = "None"
@@ -57,6 +62,11 @@ class Header(BaseModel):
     ship_via: Optional[str] = "None"
     payment_terms: Optional[str] = "None"
 
+    @field_serializer("vendor")
+    def _vendor_as_none_string(self, vendor: Optional[Party]):
+        # Missing vendor is written as "None", like every other missing field
+        return "None" if vendor is None else vendor
+
 
 class LineItem(BaseModel):
     line_no: Optional[str] = "None"
@@ -92,14 +102,14 @@ class FieldHint:
 
 class PromptBuilder:
     BASE_RULES = (
-        "You are an expert data extraction model. Extract all fields from a roofing work-order PDF into valid JSON.\n"
-        "- Use contextual clues (like proximity or headers) to populate fields, even if not explicitly labeled.\n"
-        "- Do NOT fabricate values. Use only information visible in the text.\n"
-        "- If a field is missing or unreadable, return the literal string \"None\".\n"
-        "- Preserve all numeric fields as strings if unsure, but prefer integer for quantities.\n"
-        "- Dates must be in YYYY-MM-DD format if detected; otherwise use \"None\".\n"
-        "- Return ONLY valid JSON matching this structure:\n"
-        "{ \"extraction\": [ { \"header\": {...}, \"line_items\": [...] } ] }\n"
+        "Extract all fields from a roofing work-order PDF into JSON.\n"
+        "- Use context (proximity, headers) for unlabeled fields.\n"
+        "- Never fabricate; use only visible text.\n"
+        "- Missing/unreadable -> \"None\".\n"
+        "- Quantities int; other numbers string if unsure.\n"
+        "- Dates YYYY-MM-DD, else \"None\".\n"
+        "- Shape: {\"extraction\":[{\"header\":{...},\"line_items\":[...]}]}\n"
+        "- Output JSON only. No prose, no markdown fences, no explanation.\n"
     )
 
     def __init__(self):
@@ -108,70 +118,171 @@ class PromptBuilder:
     def add_hint(self, path: str, hint: str):
         self.field_hints.append(FieldHint(path, hint))
 
-    def build(self, pdf_text: str) -> str:
-        hint_lines = "\n".join([f"- {h.path}: {h.hint}" for h in self.field_hints])
-        return (
-            self.BASE_RULES
-            + "\nField-Level Hints:\n"
-            + hint_lines
-            + "\n\nPDF_TEXT START\n"
-            + pdf_text.strip()
-            + "\nPDF_TEXT END\n\nRETURN: Valid JSON only."
-        )
+    def build_instructions(self) -> str:
+        """Invariant rules + hints, identical for every PDF."""
+        hint_lines = "\n".join([f"{h.path}: {h.hint}" for h in self.field_hints])
+        return self.BASE_RULES + "\nHints:\n" + hint_lines
+
+    @staticmethod
+    def build_request(pdf_text: str = "") -> str:
+        """Per-PDF part of the prompt; omits the PDF_TEXT block when the PDF is attached as a file."""
+        if pdf_text.strip():
+            return "PDF_TEXT START\n" + pdf_text.strip() + "\nPDF_TEXT END\n\nExtract the work order above."
+        return "Extract the attached work-order PDF."
 
 
-def build_final_prompt(pdf_text: str) -> str:
+def default_prompt_builder() -> PromptBuilder:
     pb = PromptBuilder()
 
     # Header hints
-    pb.add_hint("header.job_number", "Use 'WO #' or similar as job_number.")
-    pb.add_hint("header.date_ordered", "Extract from 'Start Date' or similar label.")
-    pb.add_hint("header.delivery_date", "Extract from 'Delivery Date'")
-    pb.add_hint("header.bill_to.name", "Customer or company name only (exclude address numbers).")
-    pb.add_hint("header.bill_to.address1", "Street number and name of the billing address (e.g., '89 streetsman').")
-    pb.add_hint("header.bill_to.city", "City associated with billing address.")
-    pb.add_hint("header.bill_to.state", "State abbreviation (like PN, GA, etc.).")
-    pb.add_hint("header.bill_to.zip", "Numeric ZIP code, even if short (e.g., '98').")
-    pb.add_hint("header.ship_to", "If separate shipping section is not found, use same details as bill_to.")
-    pb.add_hint("header.buyer_contact.name", "Name of project consultant or manager.")
-    pb.add_hint("header.buyer_contact.contact_number", "Phone number of the consultant or manager.")
-    pb.add_hint("header.shipping_contact.name", "Contact responsible for delivery/shipping if mentioned.")
-    pb.add_hint("header.shipping_instructions", "Include all crew and delivery-related notes and instructions.")
+    pb.add_hint("header.job_number", "'WO #' or similar")
+    pb.add_hint("header.date_ordered", "'Start Date' or similar")
+    pb.add_hint("header.delivery_date", "'Delivery Date'")
+    pb.add_hint("header.bill_to.name", "customer/company name, no address numbers")
+    pb.add_hint("header.bill_to.address1", "street number + name (e.g. '89 streetsman')")
+    pb.add_hint("header.bill_to.state", "state abbrev (PN, GA)")
+    pb.add_hint("header.bill_to.zip", "numeric ZIP, even if short (e.g. '98')")
+    pb.add_hint("header.ship_to", "no shipping section -> copy bill_to")
+    pb.add_hint("header.buyer_contact.name", "project consultant/manager")
+    pb.add_hint("header.buyer_contact.contact_number", "consultant/manager phone")
+    pb.add_hint("header.shipping_contact.name", "delivery/shipping contact if any")
+    pb.add_hint("header.shipping_instructions", "all crew + delivery notes")
 
     # Line items
-    pb.add_hint("line_items", "Extract every material line (e.g., taps, buckets, ring) as a separate entry.")
-    pb.add_hint("line_items.quantity", "Numeric quantity preceding item name; round decimals if needed.")
-    pb.add_hint("line_items.product_description", "Full product/material description.")
-    pb.add_hint("line_items.spell_corrected_product_description", "Same as description, corrected if typos exist.")
+    pb.add_hint("line_items.quantity", "number before item name; round decimals")
+
+    return pb
+
 
-    return pb.build(pdf_text)
+# Rules + hints never change, so build them once at import; sent as the system instruction
+SYSTEM_INSTRUCTION = default_prompt_builder().build_instructions()
+
+
+def build_final_prompt(pdf_text: str = "") -> str:
+    """Per-call prompt; the rules + hints live in the model's system instruction."""
+    return PromptBuilder.build_request(pdf_text)
 
 
 # ---------------------------
 # 3) PDF Text Extraction + Gemini API
 # ---------------------------
 
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """Extract all text from the PDF using PyMuPDF."""
+def extract_text_from_pdf(pdf_path: str, max_pages: Optional[int] = None) -> str:
+    """Extract text from the PDF using PyMuPDF.
+
+    max_pages stops after the leading business pages, skipping trailing T&C/attachment pages.
+    """
+    import fitz  # PyMuPDF; imported lazily to keep CLI start-up fast
+
     doc = fitz.open(pdf_path)
-    text = ""
-    for page in doc:
-        text += page.get_text("text")
+    parts = []
+    for i, page in enumerate(doc):
+        if max_pages is not None and i >= max_pages:
+            break
+        # TEXTFLAGS_TEXT is already the "text" default (no image blocks); spelled out so it stays text-only
+        parts.append(page.get_text("text", flags=fitz.TEXTFLAGS_TEXT))
     doc.close()
-    return text.strip()
+    return "".join(parts).strip()
 
 
-def call_gemini(prompt: str) -> str:
-    """Call Gemini model with forced JSON output."""
+@functools.lru_cache(maxsize=1)
+def _get_model():
+    """Resolve the Gemini model once, falling back to flash if pro is unavailable."""
+    import google.generativeai as genai
+
     try:
-        model = genai.GenerativeModel("models/gemini-2.5-pro")
+        return genai.GenerativeModel("models/gemini-2.5-pro", system_instruction=SYSTEM_INSTRUCTION)
     except Exception:
-        model = genai.GenerativeModel("models/gemini-2.5-flash")
+        return genai.GenerativeModel("models/gemini-2.5-flash", system_instruction=SYSTEM_INSTRUCTION)
 
-    response = model.generate_content(
-        prompt,
-        generation_config={"response_mime_type": "application/json"}
-    )
+
+def _gemini_schema(node: dict, defs: dict) -> dict:
+    """Convert a Pydantic JSON schema node into the OpenAPI subset Gemini accepts.
+
+    $refs are inlined and default/title keys dropped. Optional fields whose default is
+    the "None" string lose their null branch, so the model must write "None" instead of null.
+    """
+    if "$ref" in node:
+        return _gemini_schema(defs[node["$ref"].split("/")[-1]], defs)
+    if "anyOf" in node:
+        options = [o for o in node["anyOf"] if o.get("type") != "null"]
+        schema = _gemini_schema(options[0], defs)
+        if "default" in node and node["default"] is None:
+            schema["nullable"] = True
+        return schema
+
+    schema = {"type": node["type"]}
+    if "properties" in node:
+        schema["properties"] = {k: _gemini_schema(v, defs) for k, v in node["properties"].items()}
+    if "required" in node:
+        schema["required"] = list(node["required"])
+    if "items" in node:
+        schema["items"] = _gemini_schema(node["items"], defs)
+    return schema
+
+
+_ROOT_JSON_SCHEMA = RootSchema.model_json_schema()
+
+GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": _gemini_schema(_ROOT_JSON_SCHEMA, _ROOT_JSON_SCHEMA.get("$defs", {})),
+}
+
+
+# Upload errors meaning "this file was rejected"; auth, quota and server errors are re-raised
+_UPLOAD_REJECTED_STATUSES = {400, 413, 415}
+
+
+def upload_pdf(pdf_path: str, max_pages: Optional[int] = None):
+    """Upload the PDF via the Gemini Files API. Callers delete it with delete_uploaded when done.
+
+    With max_pages, only a truncated in-memory copy of the leading pages is uploaded.
+    """
+    import fitz  # PyMuPDF
+    import google.generativeai as genai
+
+    if max_pages is not None:
+        doc = fitz.open(pdf_path)
+        if doc.page_count > max_pages:
+            doc.select(range(max_pages))
+            data = doc.tobytes()
+            doc.close()
+            return genai.upload_file(
+                io.BytesIO(data), mime_type="application/pdf", display_name=os.path.basename(pdf_path)
+            )
+        doc.close()
+    return genai.upload_file(pdf_path, mime_type="application/pdf")
+
+
+def delete_uploaded(pdf_file) -> None:
+    """Delete an uploaded PDF rather than leaving it for the 48h default retention."""
+    import google.generativeai as genai
+
+    genai.delete_file(pdf_file.name)
+
+
+def prepare_request(pdf_path: str, max_pages: Optional[int] = None):
+    """Upload the PDF, falling back to local text extraction if the upload is rejected.
+
+    Returns (prompt, pdf_file); pdf_file is None on the fallback path.
+    """
+    from googleapiclient.errors import HttpError
+
+    try:
+        return build_final_prompt(), upload_pdf(pdf_path, max_pages)
+    except HttpError as e:
+        if e.resp.status not in _UPLOAD_REJECTED_STATUSES:
+            raise
+        print("⚠️ PDF upload rejected, falling back to local text extraction:", e)
+        return build_final_prompt(extract_text_from_pdf(pdf_path, max_pages)), None
+
+
+async def call_gemini_async(prompt: str, pdf_file=None) -> str:
+    """Call Gemini model with schema-constrained JSON output, optionally attaching an uploaded PDF."""
+    model = _get_model()
+    contents = [pdf_file, prompt] if pdf_file is not None else prompt
+
+    response = await model.generate_content_async(contents, generation_config=GENERATION_CONFIG)
     return response.text
 
 
@@ -179,6 +290,24 @@ def call_gemini(prompt: str) -> str:
 # 4) Normalize Gemini Output
 # ---------------------------
 
+# Schema is the source of truth for the "None" defaults
+_PARTY_DEFAULTS = Party().model_dump()
+_CONTACT_DEFAULTS = Contact().model_dump()
+_NUM_RE = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def _to_quantity(q) -> int:
+    """Coerce a quantity to int: numbers directly, strings by their leading number; else 0."""
+    if isinstance(q, (int, float)):
+        value = float(q)
+    else:
+        m = _NUM_RE.match(str(q).replace(",", "").strip()) if q is not None else None
+        if not m:
+            return 0
+        value = float(m.group())
+    return int(value) if math.isfinite(value) else 0
+
+
 def normalize_gemini_output(data: dict) -> dict:
     """Ensure valid structure and fill only missing sections."""
     if "extraction" not in data:
@@ -187,33 +316,16 @@ def normalize_gemini_output(data: dict) -> dict:
     header = data["extraction"][0].get("header", {})
 
     # Only fill missing fields; never overwrite model data
-    def ensure_party(name):
-        return {
-            k: "None" for k in [
-                "name", "address1", "address2", "address3",
-                "city", "state", "country", "country_code", "zip"
-            ]
-        }
-
-    if "ship_to" not in header:
-        header["ship_to"] = ensure_party("ship_to")
-    if "bill_to" not in header:
-        header["bill_to"] = ensure_party("bill_to")
-    if "buyer_contact" not in header:
-        header["buyer_contact"] = {"name": "None", "email": "None", "contact_number": "None"}
-    if "shipping_contact" not in header:
-        header["shipping_contact"] = {"name": "None", "email": "None", "contact_number": "None"}
+    header.setdefault("ship_to", _PARTY_DEFAULTS.copy())
+    header.setdefault("bill_to", _PARTY_DEFAULTS.copy())
+    header.setdefault("buyer_contact", _CONTACT_DEFAULTS.copy())
+    header.setdefault("shipping_contact", _CONTACT_DEFAULTS.copy())
+    if header.get("vendor") == "None":
+        header["vendor"] = None
 
     # Normalize quantities
     for li in data["extraction"][0].get("line_items", []):
-        q = li.get("quantity")
-        if q is None:
-            li["quantity"] = 0
-        else:
-            try:
-                li["quantity"] = int(float(q))
-            except Exception:
-                li["quantity"] = 0
+        li["quantity"] = _to_quantity(li.get("quantity"))
 
     return data
 
@@ -222,33 +334,137 @@ def normalize_gemini_output(data: dict) -> dict:
 # 5) Main Runner
 # ---------------------------
 
-def main():
-    load_dotenv()
-    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+DEFAULT_OUT_DIR = "output"
+
 
-    pdf_path = "99907349 Roof 3-redacted.pdf"
-    pdf_text = extract_text_from_pdf(pdf_path)
-    prompt = build_final_prompt(pdf_text)
+def output_path_for(pdf_path: str, out_dir: str = DEFAULT_OUT_DIR) -> str:
+    """Output JSON path for a PDF, e.g. 'in/order.pdf' -> '<out_dir>/order-output.json'."""
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return os.path.join(out_dir, stem + "-output.json")
 
-    print("🚀 Sending prompt to Gemini...")
-    llm_output = call_gemini(prompt)
 
+def save_output(
+    pdf_path: str, llm_output: str, out_dir: str = DEFAULT_OUT_DIR, print_result: bool = False
+) -> Optional[RootSchema]:
+    """Validate and save the model output. Returns None if it fails validation."""
     try:
-        data = json.loads(llm_output)
+        data = orjson.loads(llm_output)
         data = normalize_gemini_output(data)
         validated = RootSchema.model_validate(data)
+        output = validated.model_dump_json(indent=2)
 
-        print("✅ Extraction Successful!\n")
-        print(json.dumps(validated.model_dump(), indent=2, ensure_ascii=False))
+        print(f"✅ Extraction Successful for {pdf_path}!")
+        if print_result:
+            print(output)
 
-        with open("roof_order_output.json", "w", encoding="utf-8") as f:
-            json.dump(validated.model_dump(), f, indent=2, ensure_ascii=False)
+        out_path = output_path_for(pdf_path, out_dir)
+        with open(out_path, "w", encoding="utf-8") as f:
+            f.write(output)
 
-        print("\n💾 Saved to roofing_work_order_output.json")
+        print(f"💾 Saved to {out_path}")
+        return validated
 
     except (json.JSONDecodeError, ValidationError) as e:
         print("❌ Error parsing/validating JSON:\n", e)
         print("\nRaw Output:\n", llm_output)
+        return None
+
+
+async def process_pdf(
+    pdf_path: str,
+    semaphore: asyncio.Semaphore,
+    out_dir: str = DEFAULT_OUT_DIR,
+    max_pages: Optional[int] = None,
+    print_result: bool = False,
+) -> Optional[RootSchema]:
+    """Extract, validate and save one PDF, holding the semaphore while talking to Gemini.
+
+    Failures are reported and return None so one bad PDF does not abort the rest of the run.
+    """
+    try:
+        async with semaphore:
+            prompt, pdf_file = await asyncio.to_thread(prepare_request, pdf_path, max_pages)
+
+            print(f"🚀 Sending prompt to Gemini for {pdf_path}...")
+            try:
+                llm_output = await call_gemini_async(prompt, pdf_file)
+            finally:
+                if pdf_file is not None:
+                    await asyncio.to_thread(delete_uploaded, pdf_file)
+
+        return save_output(pdf_path, llm_output, out_dir, print_result)
+    except Exception as e:
+        print(f"❌ Failed to process {pdf_path}:", e)
+        return None
+
+
+async def process_all(
+    pdf_paths: List[str],
+    concurrency: int,
+    out_dir: str = DEFAULT_OUT_DIR,
+    max_pages: Optional[int] = None,
+    print_result: bool = False,
+) -> List[Optional[RootSchema]]:
+    """Process PDFs concurrently, with at most `concurrency` requests in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *[process_pdf(p, semaphore, out_dir, max_pages, print_result) for p in pdf_paths]
+    )
+
+
+def _positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1."""
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer, got {value!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract structured data from roofing work-order PDFs.")
+    parser.add_argument(
+        "path", nargs="?", default="99907349 Roof 3-redacted.pdf",
+        help="PDF file, or a folder of PDFs to process in one run."
+    )
+    parser.add_argument(
+        "--concurrency", type=_positive_int, default=4,
+        help="Maximum concurrent Gemini requests in folder mode (default: 4)."
+    )
+    parser.add_argument(
+        "--out-dir", default=DEFAULT_OUT_DIR,
+        help=f"Folder for <name>-output.json results (default: {DEFAULT_OUT_DIR})."
+    )
+    parser.add_argument(
+        "--max-pages", type=_positive_int, default=None,
+        help="Only send the first N pages of each PDF, skipping trailing T&C/attachment pages."
+    )
+    parser.add_argument(
+        "--print", dest="print_result", action=argparse.BooleanOptionalAction, default=False,
+        help="Also print each extracted JSON to stdout (default: off)."
+    )
+    args = parser.parse_args()
+
+    import google.generativeai as genai
+
+    load_dotenv()
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+    if os.path.isdir(args.path):
+        pdf_paths = sorted(
+            os.path.join(args.path, name) for name in os.listdir(args.path)
+            if name.lower().endswith(".pdf")
+        )
+    else:
+        pdf_paths = [args.path]
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    _get_model()  # resolve before entering the event loop
+    asyncio.run(process_all(
+        pdf_paths, args.concurrency, args.out_dir, args.max_pages, args.print_result
+    ))
 
 
 if __name__ == "__main__":